@@ -1,22 +1,23 @@
-import json
 import time
 import os
 from dotenv import load_dotenv
-import io
-import base64
 import numpy as np
 from datetime import datetime
-from collections import deque
+from collections import namedtuple
 from picamera2 import Picamera2
 import cv2
 import google.generativeai as genai
+from concurrent.futures import ThreadPoolExecutor
 import threading
-from queue import Queue
-from multiprocessing import Queue as MPQueue, Value
+from multiprocessing import Value
 import ctypes
 
 load_dotenv()
-image_queue = Queue()
+
+# Worker pool for Gemini requests; the semaphore keeps frames from queueing up behind busy workers
+GEMINI_MAX_IN_FLIGHT = 2
+gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_IN_FLIGHT)
+gemini_slots = threading.BoundedSemaphore(GEMINI_MAX_IN_FLIGHT)
 
 # Queue for Gemini responses to be sent to main process
 gemini_response_queue = None  # Will be set by main.py when running as subprocess
@@ -27,6 +28,11 @@ MIN_SEND_INTERVAL = 15.0  # Minimum 10 seconds between API calls
 STABILITY_WINDOW = 3  # Number of stable frames required
 CHANGE_THRESHOLD = 0.3  # 15% change threshold for detecting environment change
 STABILITY_THRESHOLD = 0.025  # 5% threshold for considering scene "stable"
+ANALYSIS_SIZE = (160, 90)  # Thumbnail size used for scene-change detection
+JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 85]  # Encoding params for images sent to Gemini
+
+# Scene features extracted from a frame
+Features = namedtuple('Features', ['brightness', 'hist'])  # hist is H, S, V 16-bin histograms concatenated
 
 # Shared value for num_instruments (will be set by main.py)
 num_instruments_shared = None
@@ -58,96 +64,103 @@ def change_num_instruments(num):
         num_instruments_local = num
 
 def create_shared_num_instruments(initial_value=3):
-    """Create a shared Value for num_instruments to be passed to subprocess."""
-    return Value(ctypes.c_int, initial_value)
+    """Create a lock-free shared c_int for num_instruments to pass to the subprocess."""
+    return Value(ctypes.c_int, initial_value, lock=False)
 
 def create_shared_trigger_capture():
-    """Create a shared Value flag for triggering immediate capture."""
-    return Value(ctypes.c_int, 0)
+    """Create a lock-free shared c_int flag for triggering immediate capture."""
+    return Value(ctypes.c_int, 0, lock=False)
+
+def chisqr_alt(hist1, hist2):
+    """Alternative chi-square distance (cv2.HISTCMP_CHISQR_ALT) over the last axis."""
+    diff = hist1 - hist2
+    total = hist1 + hist2
+    terms = np.divide(diff * diff, total, out=np.zeros_like(diff), where=total > 0)
+    return 2.0 * terms.sum(axis=-1)
 
 class ImageAnalyzer:
     def __init__(self):
         self.last_sent_time = 0
         self.last_sent_image = None
-        self.recent_features = deque(maxlen=STABILITY_WINDOW + 1)
+        # Ring buffer of recent frame features, one array per field
+        self.brightness_buf = np.zeros(STABILITY_WINDOW + 1, np.float32)
+        self.hist_buf = np.zeros((STABILITY_WINDOW + 1, 48), np.float32)
+        self.write_idx = 0
+        self.filled = 0
         self.change_detected = False
         self.stable_count = 0
 
     def extract_features(self, image):
         """Extract brightness and color histogram features from image."""
-        # Convert to different color spaces
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        # Brightness is the mean of grayscale, which is linear in the channel
+        # means, so take it from cv2.mean instead of building a gray image
+        mean_b, mean_g, mean_r, _ = cv2.mean(image)
+        brightness = (0.114 * mean_b + 0.587 * mean_g + 0.299 * mean_r) / 255.0
 
-        # Calculate brightness (mean of grayscale)
-        brightness = np.mean(gray) / 255.0
-
-        # Calculate color histogram (normalized)
-        hist_h = cv2.calcHist([hsv], [0], None, [16], [0, 180]).flatten()
-        hist_s = cv2.calcHist([hsv], [1], None, [16], [0, 256]).flatten()
-        hist_v = cv2.calcHist([hsv], [2], None, [16], [0, 256]).flatten()
+        # Single joint H/S/V histogram pass, then marginalize per channel
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        hist = cv2.calcHist([hsv], [0, 1, 2], None, [16, 16, 16], [0, 180, 0, 256, 0, 256])
+        hist_all = np.concatenate([
+            hist.sum(axis=(1, 2)),
+            hist.sum(axis=(0, 2)),
+            hist.sum(axis=(0, 1))
+        ])
 
-        # Normalize histograms
-        hist_h = hist_h / (hist_h.sum() + 1e-7)
-        hist_s = hist_s / (hist_s.sum() + 1e-7)
-        hist_v = hist_v / (hist_v.sum() + 1e-7)
+        # Normalize each channel (all three share the joint total), as float32 to match the ring buffer
+        hist_all = (hist_all / (hist.sum() + 1e-7)).astype(np.float32, copy=False)
 
-        return {
-            'brightness': brightness,
-            'hist_h': hist_h,
-            'hist_s': hist_s,
-            'hist_v': hist_v
-        }
+        return Features(brightness, hist_all)
 
     def compare_features(self, feat1, feat2):
-        """Compare two feature sets and return difference score."""
+        """Compare two feature sets and return difference score.
+
+        Fields may carry a leading axis, in which case one score is
+        returned per pair of rows.
+        """
         if feat1 is None or feat2 is None:
             return 1.0  # Maximum difference if no comparison possible
 
         # Brightness difference
-        brightness_diff = abs(feat1['brightness'] - feat2['brightness'])
+        brightness_diff = np.abs(feat1.brightness - feat2.brightness)
 
-        # Histogram differences using chi-square distance
-        hist_h_diff = cv2.compareHist(
-            feat1['hist_h'].astype(np.float32),
-            feat2['hist_h'].astype(np.float32),
-            cv2.HISTCMP_CHISQR_ALT
-        )
-        hist_s_diff = cv2.compareHist(
-            feat1['hist_s'].astype(np.float32),
-            feat2['hist_s'].astype(np.float32),
-            cv2.HISTCMP_CHISQR_ALT
-        )
-        hist_v_diff = cv2.compareHist(
-            feat1['hist_v'].astype(np.float32),
-            feat2['hist_v'].astype(np.float32),
-            cv2.HISTCMP_CHISQR_ALT
-        )
+        # Histogram differences using chi-square distance, per 16-bin H/S/V channel
+        hist_diff = np.minimum(chisqr_alt(
+            feat1.hist.reshape(feat1.hist.shape[:-1] + (3, 16)),
+            feat2.hist.reshape(feat2.hist.shape[:-1] + (3, 16))
+        ), 1.0)
 
         # Combine differences (weighted average)
         total_diff = (
             brightness_diff * 0.3 +
-            min(hist_h_diff, 1.0) * 0.25 +
-            min(hist_s_diff, 1.0) * 0.2 +
-            min(hist_v_diff, 1.0) * 0.25
+            hist_diff[..., 0] * 0.25 +
+            hist_diff[..., 1] * 0.2 +
+            hist_diff[..., 2] * 0.25
         )
 
-        return min(total_diff, 1.0)
+        return np.minimum(total_diff, 1.0)
 
     def is_scene_stable(self):
         """Check if recent frames are stable (not changing much)."""
-        if len(self.recent_features) < STABILITY_WINDOW:
+        if self.filled < STABILITY_WINDOW:
             return False
 
-        recent = list(self.recent_features)[-STABILITY_WINDOW:]
+        # Ring indices of the last STABILITY_WINDOW frames, oldest first
+        idx = (self.write_idx + np.arange(-STABILITY_WINDOW, 0)) % len(self.brightness_buf)
+        brightness = self.brightness_buf[idx]
+        hist = self.hist_buf[idx]
 
-        # Compare consecutive frames in the stability window
-        for i in range(len(recent) - 1):
-            diff = self.compare_features(recent[i], recent[i + 1])
-            if diff > STABILITY_THRESHOLD:
-                return False
+        # The brightness term is a lower bound on each score, so a large
+        # brightness jump rejects without scoring the histograms
+        if np.any(np.abs(np.diff(brightness)) * 0.3 > STABILITY_THRESHOLD):
+            return False
+
+        # Compare all consecutive frames in the stability window at once
+        diffs = self.compare_features(
+            Features(brightness[:-1], hist[:-1]),
+            Features(brightness[1:], hist[1:])
+        )
 
-        return True
+        return bool(np.all(diffs <= STABILITY_THRESHOLD))
 
     def should_send_to_api(self, current_features):
         """Determine if we should send the current image to Gemini API."""
@@ -186,7 +199,10 @@ class ImageAnalyzer:
     def process_image(self, image):
         """Process a captured image and decide whether to send to API."""
         features = self.extract_features(image)
-        self.recent_features.append(features)
+        self.brightness_buf[self.write_idx] = features.brightness
+        self.hist_buf[self.write_idx] = features.hist
+        self.write_idx = (self.write_idx + 1) % len(self.brightness_buf)
+        self.filled = min(self.filled + 1, len(self.brightness_buf))
 
         should_send, reason = self.should_send_to_api(features)
 
@@ -198,12 +214,6 @@ class ImageAnalyzer:
         return False, None
 
 
-def image_to_base64(image):
-    """Convert OpenCV image to base64 string."""
-    _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
-    return base64.b64encode(buffer).decode('utf-8')
-
-
 def send_to_gemini(image_part):
     """Send image to Gemini API for analysis."""
     global num_instruments_shared
@@ -253,11 +263,20 @@ def send_to_gemini(image_part):
         return None
 
 
-def get_gemini_response():
+def get_gemini_response(image):
     global gemini_response_queue
-    image = image_queue.get()
     timestamp = datetime.now().strftime("%H:%M:%S")
-    response = send_to_gemini(image)
+
+    # Convert image to bytes
+    _, buffer = cv2.imencode('.jpg', image, JPEG_PARAMS)
+    image_bytes = buffer.tobytes()
+
+    # Create image part for Gemini
+    image_part = {
+        "mime_type": "image/jpeg",
+        "data": image_bytes
+    }
+    response = send_to_gemini(image_part)
 
     if response:
         print(f"[{timestamp}] Gemini Response:")
@@ -265,14 +284,35 @@ def get_gemini_response():
         print(response[:500] + "..." if len(response) > 500 else response)
         print("-" * 30)
 
-        # Add response to queue for socket.io emission
+        # Add response to queue for socket.io emission, stripping the
+        # ```json ... ``` fence Gemini wraps around the payload
         if gemini_response_queue is not None:
-            gemini_response_queue.put(response)
+            gemini_response_queue.put(response.strip().removeprefix('```json').removesuffix('```').strip())
             print(f"[{timestamp}] Response added to emission queue")
     else:
         print(f"[{timestamp}] Failed to get response from Gemini")
 
 
+def gemini_request_done(future):
+    gemini_slots.release()
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Error in Gemini request: {future.exception()}")
+
+
+def submit_gemini_request(image):
+    """Hand image to a free Gemini worker. Returns False (dropping the frame) if all are busy."""
+    if not gemini_slots.acquire(blocking=False):
+        return False
+    try:
+        future = gemini_executor.submit(get_gemini_response, image)
+    except RuntimeError:
+        # Executor already shut down
+        gemini_slots.release()
+        return False
+    future.add_done_callback(gemini_request_done)
+    return True
+
+
 def main(response_queue=None, shared_num_instruments=None, shared_trigger_capture=None):
     global gemini_response_queue, num_instruments_shared, trigger_capture_shared
     gemini_response_queue = response_queue
@@ -289,7 +329,7 @@ def main(response_queue=None, shared_num_instruments=None, shared_trigger_captur
     # Initialize PiCamera2
     picam2 = Picamera2()
     config = picam2.create_still_configuration(
-        main={"size": (1280, 720), "format": "RGB888"}
+        main={"size": (1280, 720), "format": "BGR888"}
     )
     picam2.configure(config)
     picam2.start()
@@ -309,10 +349,14 @@ def main(response_queue=None, shared_num_instruments=None, shared_trigger_captur
 
     try:
         loop_count = 0
+        next_capture = time.monotonic()
         while True:
+            next_capture += CAPTURE_INTERVAL
+
             # Capture image
             image = picam2.capture_array()
-            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+            # Scene-change detection only needs a thumbnail, not the full frame
+            small = cv2.resize(image, ANALYSIS_SIZE, interpolation=cv2.INTER_AREA)
             frame_count += 1
             loop_count += 1
 
@@ -330,7 +374,7 @@ def main(response_queue=None, shared_num_instruments=None, shared_trigger_captur
                 print(f"[{timestamp}] GSR trigger detected! Forcing Gemini API call...")
 
             # Process image and check if we should send to API
-            should_send, reason = analyzer.process_image(image)
+            should_send, reason = analyzer.process_image(small)
 
             # Send if normal conditions met OR if GSR triggered
             if should_send or gsr_triggered:
@@ -340,31 +384,27 @@ def main(response_queue=None, shared_num_instruments=None, shared_trigger_captur
                 # Update analyzer state if GSR triggered to prevent duplicate sends
                 if gsr_triggered:
                     analyzer.last_sent_time = time.time()
-                    analyzer.last_sent_image = analyzer.extract_features(image)
-
-                # Convert image to bytes
-                _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                image_bytes = buffer.tobytes()
-
-                # Create image part for Gemini
-                image_part = {
-                    "mime_type": "image/jpeg",
-                    "data": image_bytes
-                }
-                image_queue.put(image_part)
-                response_thread = threading.Thread(target=get_gemini_response, daemon=True)
-                response_thread.start()
+                    analyzer.last_sent_image = analyzer.extract_features(small)
+
+                # JPEG encoding happens on a Gemini worker, off the capture loop
+                if not submit_gemini_request(image):
+                    print(f"[{timestamp}] Frame {frame_count}: Gemini workers busy, skipping")
             else:
                 status = "change detected, waiting for stability" if analyzer.change_detected else "monitoring"
                 print(f"[{timestamp}] Frame {frame_count}: {status}")
 
-            # Wait for next capture
-            time.sleep(CAPTURE_INTERVAL)
+            # Wait for next capture, resyncing instead of bursting if we fell behind
+            delay = next_capture - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_capture = time.monotonic()
 
     except KeyboardInterrupt:
         print("\nShutting down...")
     finally:
         picam2.stop()
+        gemini_executor.shutdown(wait=False, cancel_futures=True)
         print("Camera stopped.")
 
 if __name__ == "__main__":
@@ -1,10 +1,11 @@
 import serial
-import json
+import orjson
 import threading
-from queue import Queue
+from queue import SimpleQueue
 
-# Serial data queue (thread-safe)
-serial_queue = Queue()
+# Serial data queue (thread-safe; SimpleQueue is C-implemented and lighter than Queue
+# since we never need task_done/join or maxsize)
+serial_queue = SimpleQueue()
 
 serial_counter = 0
 
@@ -17,15 +18,18 @@ def read_serial_data():
         print("Serial connection established with ESP32")
 
         while True:
-            if ser.in_waiting > 0:
-                line = json.loads(ser.readline().decode('utf-8').rstrip())
-                if line:
-                    serial_queue.put(line)
-                    global serial_counter
-                    serial_counter += 1
-                    if serial_counter > 10:
-                        print(f"[GPIO] Received: {line}")
-                        serial_counter = 0
+            # Blocks until a full line arrives (or the port timeout expires)
+            raw = ser.readline()
+            if not raw.strip():
+                continue
+            line = orjson.loads(raw)
+            if line:
+                serial_queue.put(line)
+                global serial_counter
+                serial_counter += 1
+                if serial_counter > 10:
+                    print(f"[GPIO] Received: {line}")
+                    serial_counter = 0
 
     except Exception as e:
         print(f"Serial read error: {e}")
@@ -1,17 +1,24 @@
-import json
+import orjson
 
 import socketio
 import time
 import threading
-from queue import Empty
+from bisect import bisect_right
+from collections import deque
 from multiprocessing import Process, Queue as MPQueue
 
-from cam_process import change_num_instruments, main as camera_main, create_shared_num_instruments, create_shared_trigger_capture
+from cam_process import main as camera_main, create_shared_num_instruments, create_shared_trigger_capture
 # Import the serial queue from gpio_in
 from gpio_in import serial_queue, start_serial_thread
 
-# Create a Socket.IO client
-sio = socketio.Client()
+# Create a Socket.IO client (reconnects on its own, retrying forever with backoff)
+sio = socketio.Client(
+    reconnection=True,
+    reconnection_attempts=0,
+    reconnection_delay=1,
+    reconnection_delay_max=10,
+    randomization_factor=0.5
+)
 
 console_counter = 1
 
@@ -19,29 +26,79 @@ console_counter = 1
 SERVER_URL = "https://conanima.pynekoyne.com"
 SOCKET_PATH = "/"
 
+# Bio packets are only re-sent unchanged this often (seconds), as a liveness heartbeat
+BIO_HEARTBEAT_INTERVAL = 2.0
+
+class SlidingRange:
+    """Sliding window over the last `size` readings with O(1) amortized max - min."""
+
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        # Monotonic deques of (index, value): decreasing for max, increasing for min
+        self._maxima = deque()
+        self._minima = deque()
+
+    def append(self, value):
+        index = self.count
+        self.count += 1
+
+        while self._maxima and self._maxima[-1][1] <= value:
+            self._maxima.pop()
+        self._maxima.append((index, value))
+        while self._minima and self._minima[-1][1] >= value:
+            self._minima.pop()
+        self._minima.append((index, value))
+
+        # At most one reading leaves the window per append
+        if self._maxima[0][0] <= index - self.size:
+            self._maxima.popleft()
+        if self._minima[0][0] <= index - self.size:
+            self._minima.popleft()
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def range(self):
+        """Return max - min of the readings currently in the window."""
+        return self._maxima[0][1] - self._minima[0][1]
+
 # GSR stability tracking
 GSR_CHANGE_THRESHOLD = 15  # Minimum GSR change to consider "drastic"
 GSR_STABILITY_WINDOW = 5   # Number of readings to check for stability
 GSR_STABILITY_THRESHOLD = 5  # Max variation to consider "stable"
-gsr_history = []
+GSR_INSTRUMENT_THRESHOLDS = (30, 50, 85)  # GSR bucket upper bounds
+GSR_INSTRUMENT_COUNTS = (2, 3, 5, 6)  # num_instruments for each GSR bucket
+GSR_INSTRUMENT_MIN_INTERVAL = 0.25  # Min seconds between num_instruments changes (debounces bucket flapping)
+gsr_history = SlidingRange(GSR_STABILITY_WINDOW)
 last_stable_gsr = None
 gsr_change_detected = False
 
-# Shared data state (thread-safe with lock)
-data_lock = threading.Lock()
+# Shared data state (never mutated in place; the producer publishes a new
+# dict by rebinding the name, which is atomic, so readers need no lock)
 current_sensor_data = {
     "bpm": 0,
     "gsr": 0,
     "temp": 0,
 }
 
+# Set while the Socket.IO connection is up; emitter threads wait on it
+server_connected = threading.Event()
+
+# Outgoing bio packet, reused every tick by the sender thread
+bio_packet = {"data": current_sensor_data}
+
 # Camera process control
 camera_lock = threading.Lock()
 camera_process = None
-camera_running = False
+camera_state = "idle"  # idle -> starting -> running -> stopping -> idle; guarded by camera_lock
+camera_pending = None  # "start"/"stop" received mid-transition, applied once the transition finishes
 
 # Shared value for num_instruments (shared between main process and camera subprocess)
-shared_num_instruments = create_shared_num_instruments(3)
+# This process is its only writer, so keep a local copy to compare against instead of reading it back
+num_instruments = 3
+num_instruments_changed_at = 0.0  # time.monotonic() of the last change
+shared_num_instruments = create_shared_num_instruments(num_instruments)
 
 # Shared flag to trigger immediate camera capture
 shared_trigger_capture = create_shared_trigger_capture()
@@ -52,10 +109,12 @@ gemini_response_queue = MPQueue()
 @sio.event
 def connect():
     print("[API] Connected to server!")
+    server_connected.set()
 
 @sio.event
 def disconnect():
     print("[API] Disconnected from server!")
+    server_connected.clear()
 
 @sio.event
 def connect_error(data):
@@ -64,103 +123,146 @@ def connect_error(data):
 @sio.on('start')
 def on_start(data=None):
     """Handle start command from backend to start camera script."""
-    global camera_process, camera_running
     print(f"[API] Received 'start' command: {data}")
+    start_camera()
 
+@sio.on('stop')
+def on_stop(data=None):
+    """Handle stop command from backend to stop camera script."""
+    print(f"[API] Received 'stop' command: {data}")
+    stop_camera()
+
+def start_camera():
+    """Start the camera process, or queue the start if a stop is in progress."""
+    global camera_process, camera_state, camera_pending
+
+    # Claim the start under the lock, but spawn the process outside it
     with camera_lock:
-        if camera_running:
+        if camera_state == "stopping":
+            print("[CAMERA] Camera is stopping; will start once stopped")
+            camera_pending = "start"
+            return
+        if camera_state != "idle":
+            # A start after a queued stop cancels that stop
+            camera_pending = None
             print("[CAMERA] Camera is already running")
             sio.emit('camera_status', {'status': 'already_running'})
             return
+        camera_state = "starting"
 
-        try:
-            # Start the camera process using multiprocessing
-            camera_process = Process(
-                target=camera_main,
-                args=(gemini_response_queue, shared_num_instruments, shared_trigger_capture),
-                daemon=True
-            )
-            camera_process.start()
-            camera_running = True
-            print(f"[CAMERA] Camera script started (PID: {camera_process.pid})")
-            sio.emit('camera_status', {'status': 'started', 'pid': camera_process.pid})
-        except Exception as e:
-            print(f"[CAMERA] Failed to start camera: {e}")
-            sio.emit('camera_status', {'status': 'error', 'message': str(e)})
-
-@sio.on('stop')
-def on_stop(data=None):
-    """Handle stop command from backend to stop camera script."""
-    global camera_process, camera_running
-    print(f"[API] Received 'stop' command: {data}")
+    try:
+        # Start the camera process using multiprocessing
+        process = Process(
+            target=camera_main,
+            args=(gemini_response_queue, shared_num_instruments, shared_trigger_capture),
+            daemon=True
+        )
+        process.start()
+    except Exception as e:
+        with camera_lock:
+            camera_state = "idle"
+            camera_pending = None
+        print(f"[CAMERA] Failed to start camera: {e}")
+        sio.emit('camera_status', {'status': 'error', 'message': str(e)})
+        return
 
     with camera_lock:
-        if not camera_running or camera_process is None:
+        camera_process = process
+        camera_state = "running"
+        pending, camera_pending = camera_pending, None
+    print(f"[CAMERA] Camera script started (PID: {process.pid})")
+    sio.emit('camera_status', {'status': 'started', 'pid': process.pid})
+
+    if pending == "stop":
+        stop_camera()
+
+def terminate_camera_process(process, timeout):
+    """Terminate the camera process, killing it if it outlives timeout. Returns True if killed."""
+    process.terminate()
+    process.join(timeout=timeout)
+    if process.is_alive():
+        process.kill()
+        process.join()
+        return True
+    return False
+
+def stop_camera():
+    """Stop the camera process, or queue the stop if a start is in progress."""
+    global camera_process, camera_state, camera_pending
+
+    # Claim the stop under the lock, but wait for the process outside it
+    with camera_lock:
+        if camera_state == "starting":
+            print("[CAMERA] Camera is starting; will stop once started")
+            camera_pending = "stop"
+            return
+        if camera_state != "running":
+            # A stop after a queued start cancels that start
+            camera_pending = None
             print("[CAMERA] Camera is not running")
             sio.emit('camera_status', {'status': 'not_running'})
             return
+        camera_state = "stopping"
+        process = camera_process
 
-        try:
-            # Terminate the process
-            camera_process.terminate()
-            camera_process.join(timeout=5)
-            if camera_process.is_alive():
-                camera_process.kill()
-                camera_process.join()
-                print("[CAMERA] Camera script force killed")
-                sio.emit('camera_status', {'status': 'force_stopped'})
-            else:
-                print("[CAMERA] Camera script stopped gracefully")
-                sio.emit('camera_status', {'status': 'stopped'})
-        except Exception as e:
-            print(f"[CAMERA] Error stopping camera: {e}")
-            sio.emit('camera_status', {'status': 'error', 'message': str(e)})
-        finally:
+    try:
+        if terminate_camera_process(process, timeout=5):
+            print("[CAMERA] Camera script force killed")
+            sio.emit('camera_status', {'status': 'force_stopped'})
+        else:
+            print("[CAMERA] Camera script stopped gracefully")
+            sio.emit('camera_status', {'status': 'stopped'})
+    except Exception as e:
+        print(f"[CAMERA] Error stopping camera: {e}")
+        sio.emit('camera_status', {'status': 'error', 'message': str(e)})
+    finally:
+        with camera_lock:
             camera_process = None
-            camera_running = False
+            camera_state = "idle"
+            pending, camera_pending = camera_pending, None
+
+    if pending == "start":
+        start_camera()
 
 def process_serial_data():
     """Thread that reads from serial queue and updates sensor data."""
-    global current_sensor_data, gsr_history, last_stable_gsr, gsr_change_detected
+    global current_sensor_data, gsr_history, last_stable_gsr, gsr_change_detected, num_instruments, num_instruments_changed_at
 
     while True:
         try:
-            # Non-blocking read from serial queue
-            serial_line = serial_queue.get(timeout=1)
+            # Blocking read from serial queue (this is a dedicated thread)
+            serial_line = serial_queue.get()
+            if serial_line is None:
+                # Shutdown sentinel
+                return
 
             # Update current_sensor_data with the received data
-            # serial_line is already a dict from gpio_in.py (json.loads)
-            with data_lock:
-                if isinstance(serial_line, dict):
-                    # Update only the keys that exist in the incoming data
-                    if "bpm" in serial_line:
-                        current_sensor_data["bpm"] = serial_line["bpm"]
-                    if "gsr" in serial_line:
-                        current_sensor_data["gsr"] = serial_line["gsr"]
-                    if "temp" in serial_line:
-                        current_sensor_data["temp"] = serial_line["temp"]
+            # serial_line is already a dict from gpio_in.py (orjson.loads)
+            if isinstance(serial_line, dict):
+                # Update only the keys that exist in the incoming data
+                current_sensor_data = {
+                    "bpm": serial_line.get("bpm", current_sensor_data["bpm"]),
+                    "gsr": serial_line.get("gsr", current_sensor_data["gsr"]),
+                    "temp": serial_line.get("temp", current_sensor_data["temp"]),
+                }
 
             # Adjust instruments based on GSR value and track stability
             try:
                 gsr_value = int(serial_line["gsr"])
 
-                # Update num_instruments based on GSR
-                old_value = shared_num_instruments.value
-                if gsr_value < 30:
-                    shared_num_instruments.value = 2
-                elif gsr_value < 50:
-                    shared_num_instruments.value = 3
-                elif gsr_value < 85:
-                    shared_num_instruments.value = 5
-                else:
-                    shared_num_instruments.value = 6
-                if old_value != shared_num_instruments.value:
-                    print(f"[SENSOR] GSR={gsr_value}, num_instruments changed: {old_value} -> {shared_num_instruments.value}")
+                # Update num_instruments based on GSR, only writing the shared value when the bucket
+                # changes and at most once per GSR_INSTRUMENT_MIN_INTERVAL
+                new_value = GSR_INSTRUMENT_COUNTS[bisect_right(GSR_INSTRUMENT_THRESHOLDS, gsr_value)]
+                if num_instruments != new_value:
+                    now = time.monotonic()
+                    if now - num_instruments_changed_at >= GSR_INSTRUMENT_MIN_INTERVAL:
+                        shared_num_instruments.value = new_value
+                        print(f"[SENSOR] GSR={gsr_value}, num_instruments changed: {num_instruments} -> {new_value}")
+                        num_instruments = new_value
+                        num_instruments_changed_at = now
 
                 # Track GSR history for stability detection
                 gsr_history.append(gsr_value)
-                if len(gsr_history) > GSR_STABILITY_WINDOW:
-                    gsr_history.pop(0)
 
                 # Check for drastic change
                 if last_stable_gsr is not None:
@@ -171,7 +273,7 @@ def process_serial_data():
 
                 # Check if GSR has stabilized after a drastic change
                 if gsr_change_detected and len(gsr_history) >= GSR_STABILITY_WINDOW:
-                    gsr_range = max(gsr_history) - min(gsr_history)
+                    gsr_range = gsr_history.range()
                     if gsr_range <= GSR_STABILITY_THRESHOLD:
                         # GSR has stabilized, trigger camera capture
                         print(f"[GSR] Stabilized at ~{gsr_value} (range={gsr_range}). Triggering camera capture!")
@@ -181,7 +283,7 @@ def process_serial_data():
 
                 # Initialize last_stable_gsr if not set
                 if last_stable_gsr is None and len(gsr_history) >= GSR_STABILITY_WINDOW:
-                    gsr_range = max(gsr_history) - min(gsr_history)
+                    gsr_range = gsr_history.range()
                     if gsr_range <= GSR_STABILITY_THRESHOLD:
                         last_stable_gsr = gsr_value
                         print(f"[GSR] Initial stable value: {last_stable_gsr}")
@@ -189,82 +291,96 @@ def process_serial_data():
             except (ValueError, IndexError, KeyError) as e:
                 print(f"[SENSOR] Error adjusting instruments: {e}")
 
-        except Empty:
-            # Queue is empty, continue waiting
-            continue
         except Exception as e:
             print(f"[SENSOR] Error processing serial data: {e}")
-            time.sleep(0.1)
+            sio.sleep(0.1)
 
 def get_data_packet():
-    """Generate a JSON data packet to send."""
-    with data_lock:
-        sensor_data = current_sensor_data.copy()
-
-    return {
-        "data": {
-            "bpm": sensor_data["bpm"],
-            "gsr": sensor_data["gsr"],
-            "temp": sensor_data["temp"],
-        }
-    }
+    """Generate a JSON data packet to send (returns the shared bio_packet)."""
+    # Published snapshots are never mutated, so the current one can be sent as-is
+    bio_packet["data"] = current_sensor_data
+    return bio_packet
 
 def send_data_thread():
-    """Thread that sends data packets to the API 10 times per second."""
+    """Thread that sends data packets to the API, checking 10 times per second.
+
+    A packet is only emitted when the sensor data changed since the last
+    emit, or as a heartbeat every BIO_HEARTBEAT_INTERVAL seconds.
+    """
     interval = 0.1  # 100ms = 10 times per second
-    
+
+    last_sent_data = None
+    last_sent_at = 0.0
+    next_send = time.monotonic()
     while True:
+        if not server_connected.is_set():
+            # Sleep until (re)connected, then restart the schedule from now and resend
+            server_connected.wait()
+            next_send = time.monotonic()
+            last_sent_data = None
+        next_send += interval
         try:
-            if sio.connected:
-                packet = get_data_packet()
+            packet = get_data_packet()
+            now = time.monotonic()
+            if packet["data"] != last_sent_data or now - last_sent_at >= BIO_HEARTBEAT_INTERVAL:
+                # Serialize once and reuse for both logging and the emit (str keeps it a text frame)
+                payload = orjson.dumps(packet).decode()
                 global console_counter
                 console_counter += 1
                 if console_counter > 10:
-                    print(f"[API] Packet: {str(json.dumps(packet))}")
+                    print(f"[API] Packet: {payload}")
                     console_counter = 0
 
-                sio.emit("receiveBioPacket", str(json.dumps(packet)))
-            time.sleep(interval)
+                sio.emit("receiveBioPacket", payload)
+                last_sent_data = packet["data"]
+                last_sent_at = now
         except Exception as e:
             print(f"[API] Error sending data: {e}")
-            time.sleep(interval)
+
+        # Hold the 100 ms cadence; after a slow emit, restart from now so late ticks aren't fired back-to-back
+        delay = next_send - time.monotonic()
+        if delay > 0:
+            sio.sleep(delay)
+        else:
+            next_send = time.monotonic()
 
 def gemini_response_emitter():
     """Thread that monitors Gemini response queue and emits to backend."""
     while True:
         try:
-            # Check for Gemini responses (non-blocking with timeout)
-            try:
-                response_data = gemini_response_queue.get(timeout=0.5)
-                if sio.connected:
-                    sio.emit('camera_data', response_data[7:-3])
-                    print(f"[API] Emitted Gemini response to backend")
-                else:
-                    print(f"[API] Not connected, couldn't emit Gemini response")
-            except:
-                # Queue empty, continue
-                pass
+            # Blocking read from Gemini response queue (this is a dedicated thread)
+            response_data = gemini_response_queue.get()
+            if response_data is None:
+                # Shutdown sentinel
+                return
+            if not server_connected.is_set():
+                print(f"[API] Not connected, holding Gemini response until reconnect")
+                server_connected.wait()
+            sio.emit('camera_data', response_data)
+            print(f"[API] Emitted Gemini response to backend")
         except Exception as e:
             print(f"[API] Error emitting Gemini response: {e}")
-            time.sleep(0.1)
+            sio.sleep(0.1)
 
 def cleanup():
     """Clean up resources on shutdown."""
-    global camera_process, camera_running
+    global camera_process, camera_state, camera_pending
 
-    # Stop camera if running
+    # Stop camera if running, dropping any queued command so it isn't restarted
     with camera_lock:
-        if camera_running and camera_process is not None:
-            try:
-                camera_process.terminate()
-                camera_process.join(timeout=3)
-                if camera_process.is_alive():
-                    camera_process.kill()
-                    camera_process.join()
-            except:
-                pass
+        camera_pending = None
+        process = camera_process if camera_state == "running" else None
+        if process is not None:
+            camera_state = "stopping"
+
+    if process is not None:
+        try:
+            terminate_camera_process(process, timeout=3)
+        except:
+            pass
+        with camera_lock:
             camera_process = None
-            camera_running = False
+            camera_state = "idle"
 
     # Disconnect socket
     if sio.connected:
@@ -272,50 +388,47 @@ def cleanup():
 
 def main():
     try:
-        while True:
-            try:
-                print(f"[MAIN] Starting concurrent data acquisition and transmission...")
-                print(f"[MAIN] Connecting to {SERVER_URL}...")
-
-                # Start serial reading thread
-                start_serial_thread()
-                time.sleep(0.5)
-
-                # Connect to the API server
-                sio.connect(
-                    SERVER_URL,
-                    wait_timeout=10,
-                    namespaces = ['/']
-                )
-
-                # Start sensor data processing thread
-                sensor_thread = threading.Thread(target=process_serial_data, daemon=True)
-                sensor_thread.start()
-                print("[MAIN] Sensor processing thread started")
-
-                # Start data sending thread
-                sender_thread = threading.Thread(target=send_data_thread, daemon=True)
-                sender_thread.start()
-                print("[MAIN] Data sender thread started")
-
-                # Start Gemini response emitter thread
-                gemini_emitter_thread = threading.Thread(target=gemini_response_emitter, daemon=True)
-                gemini_emitter_thread.start()
-                print("[MAIN] Gemini response emitter thread started")
-
-                # Keep the main thread alive
-                print("[MAIN] All threads running. Press Ctrl+C to shutdown...")
-                print("[MAIN] Listening for 'start' and 'stop' commands from server...")
-                while True:
-                    time.sleep(1)
-            except Exception as e:
-                print(f"[MAIN] Error: {e}")
-            finally:
-                cleanup()
-                print("[MAIN] Cleanup complete")
+        print(f"[MAIN] Starting concurrent data acquisition and transmission...")
+        print(f"[MAIN] Connecting to {SERVER_URL}...")
+
+        # Start serial reading thread
+        start_serial_thread()
+        time.sleep(0.5)
+
+        # Connect to the API server; retry=True applies the client's reconnect backoff to the first attempt too
+        sio.connect(
+            SERVER_URL,
+            wait_timeout=10,
+            namespaces = ['/'],
+            retry=True
+        )
+
+        # Start sensor data processing thread
+        sio.start_background_task(process_serial_data)
+        print("[MAIN] Sensor processing thread started")
+
+        # Start data sending thread
+        sio.start_background_task(send_data_thread)
+        print("[MAIN] Data sender thread started")
+
+        # Start Gemini response emitter thread
+        sio.start_background_task(gemini_response_emitter)
+        print("[MAIN] Gemini response emitter thread started")
+
+        # Block the main thread until the client is permanently disconnected
+        print("[MAIN] All threads running. Press Ctrl+C to shutdown...")
+        print("[MAIN] Listening for 'start' and 'stop' commands from server...")
+        sio.wait()
+        print("[MAIN] Connection closed")
 
     except KeyboardInterrupt:
         print("\n[MAIN] Shutting down...")
+        # Wake the blocked consumer threads so they exit
+        serial_queue.put(None)
+        gemini_response_queue.put(None)
+    finally:
+        cleanup()
+        print("[MAIN] Cleanup complete")
 
 if __name__ == "__main__":
     main()